@@ -6,40 +6,37 @@ hq343@nyu.edu
 """
 
 import wfrs
-from flask import Flask, render_template, request, session, \
+from flask import Flask, Blueprint, render_template, request, session, \
                     url_for, redirect, flash, g, send_from_directory, \
-                    make_response, send_file, abort
+                    make_response, send_file, abort, current_app, \
+                    has_request_context
+from werkzeug.exceptions import HTTPException
 import urllib
 import requests
 import xml.etree.ElementTree as ET
 import datetime
+import threading
 import time
 import os
 from base64 import b64encode
+from collections import OrderedDict, deque
 
 
-# Initialize app
-app = Flask(__name__)
-# TODO: Extract these from config file or env vars
-ibi_client_protocol = "http"
-ibi_client_host = "localhost"
-ibi_client_port = "8080"  # standard is 80 for http and 443 for https
-ibi_rest_url =  \
-    f'{ibi_client_protocol}://{ibi_client_host}:{ibi_client_port}/ibi_apps/rs'
-ibi_default_folder_path = "WFC/Repository/Public"
+# Routes are registered on the app built by create_app (bottom of file)
+bp = Blueprint('wf', __name__)
 
 
-@app.route('/doc')
+@bp.route('/doc')
 def pdf():
     return send_from_directory(
-            directory=app.root_path,
+            directory=current_app.root_path,
             filename="Embedding WebFOCUS into Python Application.pdf"
         )
 
 
-@app.route('/favicon.ico')
+@bp.route('/favicon.ico')
 def favicon():
-    return send_from_directory(os.path.join(app.root_path, 'static'),
+    return send_from_directory(os.path.join(current_app.root_path, 'static'),
                                'favicon.ico',
                                mimetype='image/vnd.microsoft.icon')
 
@@ -50,32 +47,232 @@ def wf_login():
     # g is the application context; g objects are created and destroyed
     # with the same lifetime as the current request to the server
     # By creating the WF Session within g, we can use one connection
-    # per request and sign out at the end,
+    # per request and hand it back to the pool at the end,
     # rather than sign in/out for every action
 
     # Create a WF Session if one does not already exist
     if 'wf_sess' not in g:
-        g.wf_sess = wfrs.WF_Session()
-        g.wf_sess.mr_sign_on(
-            protocol=ibi_client_protocol,
-            host=ibi_client_host,
-            port=ibi_client_port
-        )
+        g.wf_sess = checkout_wf_sess()
     return g.wf_sess
 
 
+# Returns a session signed on by an earlier request (or by warm_up) if one
+# is still fresh, otherwise signs on a new one
+def checkout_wf_sess():
+    config = current_app.config
+    pool = current_app.extensions['wf_sessions']
+    while True:
+        try:
+            wf_sess = pool.popleft()
+        except IndexError:
+            break
+        if time.time() - wf_sess.signed_on_at < config['IBI_SESSION_MAX_AGE']:
+            return wf_sess
+        # Signed on too long ago; WebFOCUS may have expired it already
+        sign_off_wf_sess(wf_sess)
+    return sign_on_wf_sess()
+
+
+def sign_on_wf_sess():
+    config = current_app.config
+    # Every session shares the app's circuit breaker, and calls without
+    # their own timeout get IBI_REQUEST_TIMEOUT
+    wf_sess = wfrs.WF_Session(
+        timeout=config['IBI_REQUEST_TIMEOUT'],
+        breaker=current_app.extensions['wf_breaker'],
+        pool_maxsize=max(10, config['IBI_FAN_OUT_WORKERS'])
+    )
+    wf_sess.mr_sign_on(
+        protocol=config['IBI_CLIENT_PROTOCOL'],
+        host=config['IBI_CLIENT_HOST'],
+        port=config['IBI_CLIENT_PORT'],
+        userid=config['IBI_USER'],
+        password=config['IBI_PASSWORD']
+    )
+    return wf_sess
+
+
+# Sign off never raises; WebFOCUS may be down or the breaker open
+def sign_off_wf_sess(wf_sess):
+    try:
+        wf_sess.mr_signoff()
+    except requests.exceptions.RequestException:
+        pass
+    wf_sess.close()
+
+
+# Every cached WebFOCUS call replies with XML
+def response_ok(response):
+    if response.status_code != 200 or \
+            'html' in response.headers.get('Content-Type', ''):
+        return False
+    try:
+        ET.fromstring(response.content)
+    except ET.ParseError:
+        return False
+    return True
+
+
+# For IBFS responses, which report errors in the returncode attribute
+def response_returncode_ok(response):
+    if not response_ok(response):
+        return False
+    try:
+        return ET.fromstring(response.content).get('returncode') == "10000"
+    except ET.ParseError:
+        return False
+
+
+# wf_cache is an OrderedDict of key -> (time stored, content), kept in
+# least recently used order and capped at IBI_CACHE_SIZE entries
+def cache_get(key):
+    cache = current_app.extensions['wf_cache']
+    with current_app.extensions['wf_cache_lock']:
+        cached = cache.get(key)
+        if cached is not None:
+            cache.move_to_end(key)
+        return cached
+
+
+def cache_put(key, content):
+    cache = current_app.extensions['wf_cache']
+    with current_app.extensions['wf_cache_lock']:
+        cache[key] = (time.time(), content)
+        cache.move_to_end(key)
+        while len(cache) > current_app.config['IBI_CACHE_SIZE']:
+            cache.popitem(last=False)
+
+
+# Removes every cache entry whose key matches(key)
+def cache_drop(matches):
+    cache = current_app.extensions['wf_cache']
+    with current_app.extensions['wf_cache_lock']:
+        for key in [key for key in cache if matches(key)]:
+            del cache[key]
+
+
+# Stores the content of a valid response as the last known-good copy for
+# key and returns it. If WebFOCUS could not answer (response is None when
+# the call failed, timed out or the breaker is open, or a 5xx) returns the
+# copy stored earlier so the page can still be served, or None if there is
+# none. Any other response is a definitive error: the copy is dropped and
+# None returned.
+def revalidate(key, response, valid=response_ok):
+    if response is not None and valid(response):
+        cache_put(key, response.content)
+        return response.content
+    # A session WebFOCUS still rejects after signing on again says nothing
+    # about the item itself, so fall back as if WebFOCUS could not answer
+    rejected = response is not None and 'wf_sess' in g and \
+        g.wf_sess.is_rejected(response, expects_xml=True)
+    if response is not None and response.status_code < 500 and not rejected:
+        cache_drop(lambda cached_key: cached_key == key)
+        return None
+    cached = cache_get(key)
+    if cached is None:
+        return None
+    if has_request_context() and not g.get('wf_stale'):
+        g.wf_stale = True
+        flash("WebFOCUS is not responding; showing previously retrieved data.")
+    return cached[1]
+
+
+# GETs url with the request's WF session and returns the response content,
+# falling back to the last known-good copy when the call fails (see
+# revalidate). Raises the call's exception (or HTTPError for a 5xx) if it
+# failed and there is nothing to fall back on; returns None on a definitive
+# error. With a ttl, a cached copy is served without calling WebFOCUS, and
+# once older than ttl seconds it is refreshed in the background.
+def wf_get_cached(key, url, params, ttl=0, valid=response_ok,
+                  csrf_token=False):
+    cached = cache_get(key)
+    if cached and ttl:
+        if time.time() - cached[0] >= ttl:
+            refresh_in_background(key, url, params, valid, csrf_token)
+        return cached[1]
+    return wf_fetch(key, url, params, valid, csrf_token, cached)
+
+
+# The WebFOCUS call behind wf_get_cached; cached is key's cache entry if any
+def wf_fetch(key, url, params, valid, csrf_token, cached):
+    try:
+        wf_sess = wf_login()
+        if csrf_token:
+            params = dict(params)
+            params['IBIWF_SES_AUTH_TOKEN'] = wf_sess.IBIWF_SES_AUTH_TOKEN
+        response = wf_sess.get(url, params=params)
+    except requests.exceptions.RequestException:
+        if not cached:
+            raise
+        response = None
+    content = revalidate(key, response, valid)
+    if content is None and response is not None \
+            and response.status_code >= 500:
+        response.raise_for_status()
+    return content
+
+
+# Calls wf_fetch for key in a thread with its own app context (and so its
+# own WF session), unless a refresh of key is already running
+def refresh_in_background(key, url, params, valid, csrf_token):
+    app = current_app._get_current_object()
+    refreshing = app.extensions['wf_refreshing']
+    with app.extensions['wf_cache_lock']:
+        if key in refreshing:
+            return
+        refreshing.add(key)
+
+    def refresh():
+        try:
+            with app.app_context():
+                wf_fetch(key, url, params, valid, csrf_token, cache_get(key))
+        except requests.exceptions.RequestException as e:
+            # The cached copy is kept; the next request tries again
+            app.logger.warning(f"WebFOCUS refresh of {key} failed: {e}")
+        finally:
+            with app.extensions['wf_cache_lock']:
+                refreshing.discard(key)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+# Runs WF_Session.fan_out with the request's WF session; every call fails
+# (None) if no session can be signed on
+def wf_fan_out(calls):
+    config = current_app.config
+    try:
+        wf_sess = wf_login()
+    except requests.exceptions.RequestException:
+        return [None] * len(calls)
+    return wf_sess.fan_out(
+        calls,
+        max_workers=config['IBI_FAN_OUT_WORKERS'],
+        timeout=config['IBI_REQUEST_TIMEOUT'],
+        deadline=config['IBI_FAN_OUT_DEADLINE']
+    )
+
+
 # gets xml ET object of response
-def list_files_in_path_xml(path=ibi_default_folder_path, file_type=""):
-    wf_sess = wf_login()
+def list_files_in_path_xml(path=None, file_type=""):
+    config = current_app.config
+    path = path or config['IBI_DEFAULT_FOLDER_PATH']
     params = {'IBIRS_action': 'list'}
     # payload = {}
     # if wf_sess.IBIWF_SES_AUTH_TOKEN is not None:
     #    payload['IBIWF_SES_AUTH_TOKEN'] = wf_sess.IBIWF_SES_AUTH_TOKEN
-    response = wf_sess.get(
-        f'{ibi_rest_url}/ibfs/{path}',
-        params=params, # data=payload
+    # Listings are served from cache and refreshed in the background once
+    # older than IBI_LISTING_TTL seconds (and prefetched by warm_up); each
+    # call parses its own copy since it may remove children
+    content = wf_get_cached(
+        ('list', path),
+        f'{config["IBI_REST_URL"]}/ibfs/{path}',
+        params, # data=payload
+        ttl=config['IBI_LISTING_TTL'],
+        valid=response_returncode_ok
     )
-    files_xml_response = ET.fromstring(response.content)
+    if content is None:
+        abort(404)
+    files_xml_response = ET.fromstring(content)
     files_xml = files_xml_response.find('rootObject')
     # if requested a certain file type
     if file_type:
@@ -99,31 +296,48 @@ def files_xml_to_list(files_xml):
     return item_list
 
 
-# signs out of WF after request (closes connection)
-@app.teardown_appcontext
+# returns the WF session to the pool after request, or signs out of WF
+# (closes connection) if the request failed, the pool is full, or fan_out
+# calls abandoned at their deadline are still using the session
 def teardown_wf_sess(error=None):
     wf_sess = g.pop('wf_sess', None)
-    if wf_sess is not None:
-        wf_sess.mr_signoff()
+    if wf_sess is None:
+        return
+    pool = current_app.extensions['wf_sessions']
+    if error is None and wf_sess.IBIWF_SES_AUTH_TOKEN is not None \
+            and not wf_sess.abandoned_calls \
+            and len(pool) < current_app.config['IBI_SESSION_POOL_SIZE']:
+        pool.append(wf_sess)
+    else:
+        sign_off_wf_sess(wf_sess)
+
+
+# WebFOCUS is down, too slow, or the circuit breaker is open, and there is
+# no earlier data to show instead
+@bp.errorhandler(503)
+@bp.errorhandler(requests.exceptions.RequestException)
+def wf_unavailable(error):
+    return 'Error: Could not communicate with WebFOCUS Client' + \
+        f'<br> <a href="{url_for(".home")}">Go Back</a>', 503
 
 
 # login page
-@app.route('/', methods=['GET', 'POST'])
+@bp.route('/', methods=['GET', 'POST'])
 def index():
     if session.get('user_name'):
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
     return render_template('index.html')
 
 
 # Authenticates the login
 # Driver function - accepts any user_name and password
-@app.route('/login_auth', methods=['GET', 'POST'])
+@bp.route('/login_auth', methods=['GET', 'POST'])
 def login_auth():
     if session.get('user_name'):
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
     if request.method == 'GET':
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
     user_name = request.form['user_name']
     password = request.form['password']
@@ -134,31 +348,32 @@ def login_auth():
     if user_name and password:
         # creates a session for the the user
         session['user_name'] = user_name
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
     else:
         flash('Invalid username or password')
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
 
-@app.route('/home')
+@bp.route('/home')
 def home():
     if not session.get('user_name'):
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     return render_template('home.html')
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session['user_name'] = None
     # session['wf_sess'].mr_signoff()
     return redirect('/')
 
 
-@app.route('/delete_item', methods=['POST'])
+@bp.route('/delete_item', methods=['POST'])
 def delete_item():
     item_name = request.form.get('item_name')
     item_type = request.form.get('item_type')
     wf_sess = wf_login()
+    ibi_rest_url = current_app.config['IBI_REST_URL']
 
     payload = dict()
     if wf_sess.IBIWF_SES_AUTH_TOKEN is not None:
@@ -169,33 +384,39 @@ def delete_item():
         payload['IBIRS_service'] = 'defer'
         payload['IBIRS_ticketName'] = item_name
         response = wf_sess.post(ibi_rest_url, data=payload)
+        cache_drop(lambda key: key == ('tickets',))
     else:
         payload['IBIRS_action'] = 'delete'
         response = wf_sess.post(
             f'{ibi_rest_url}/ibfs/WFC/Repository/Public/{item_name}',
             data=payload
         )
+        # Deleted item would otherwise linger in the cached listings and
+        # could still be shown from its cached schedule details and log
+        cache_drop(lambda key: key[0] == 'list' or
+                   key == ('schedule', item_name) or
+                   key[:2] == ('log', item_name))
     message = f"Deleted Item: {item_name}" if response.status_code == 200 \
               else "Could not delete item"
     flash(message) 
     return redirect(request.referrer)
 
 
-@app.route('/run_reports')
+@bp.route('/run_reports')
 def run_reports():
     if not session.get('user_name'):
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     files_xml = list_files_in_path_xml(file_type="FexFile")
     # reports is a list of report names
     reports = files_xml_to_list(files_xml)
     return render_template('run_reports.html', reports=reports)
 
 
-@app.route('/run_report', methods=['GET', 'POST'])
+@bp.route('/run_report', methods=['GET', 'POST'])
 def run_report():
     report_name = request.form.get('report_name')
     if not report_name:
-        return redirect(url_for('run_reports'))
+        return redirect(url_for('.run_reports'))
     wf_sess = wf_login()
     # Used to properly return PDF and EXCEL files from WebFOCUS
     turn_off_redirection_xml = \
@@ -215,9 +436,12 @@ def run_report():
         'IBIRS_action': 'run',
         'IBIRS_args': turn_off_redirection_xml
     }
+    ibi_rest_url = current_app.config['IBI_REST_URL']
+    # Reports can take much longer than the other WebFOCUS calls
     wf_response = wf_sess.get(
         f'{ibi_rest_url}/ibfs/WFC/Repository/Public/{report_name}',
-        params=params
+        params=params,
+        timeout=current_app.config['IBI_RUN_TIMEOUT']
     )
     report = wf_response.content
     content_type = wf_response.headers.get('Content-Type')
@@ -239,7 +463,7 @@ def run_report():
 
 
 # Used to receive webfocus report local files (js/css) from proper source
-@app.route('/ibi_apps/<path:page>', methods=['GET', 'POST'])
+@bp.route('/ibi_apps/<path:page>', methods=['GET', 'POST'])
 def client_app_redirect(page):
     # Security: Only allow this url to serve content
     # when referred from this application
@@ -253,7 +477,7 @@ def client_app_redirect(page):
     # Use this line of code if you copy ibi html folder into static:
     # return send_from_directory('static', f'ibi_static/{page}')
     
-    base_url = f'{ibi_client_protocol}://{ibi_client_host}:{ibi_client_port}/ibi_apps/'
+    base_url = current_app.config['IBI_APPS_URL'] + '/'
     wf_sess = wf_login()
 
     # Python requests automatically decodes a gzip-encoded response
@@ -265,10 +489,10 @@ def client_app_redirect(page):
 
 
 # Schedules home page: get dropdown of schedules in the Public Repository
-@app.route('/schedules')
+@bp.route('/schedules')
 def schedules():
     if not session.get('user_name'):
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
     sched_files_xml = list_files_in_path_xml(file_type="CasterSchedule")
 
@@ -300,6 +524,28 @@ def schedules():
             item_dict['owner'] = casterObject.get('owner')
             schedule_items[item_name] = item_dict
 
+        # Fetch the details of every schedule concurrently rather than one
+        # after the other for last run status and next run time
+        ibi_rest_url = current_app.config['IBI_REST_URL']
+        schedule_names = list(schedule_items)
+        responses = wf_fan_out(
+            [('GET', f'{ibi_rest_url}/ibfs/WFC/Repository/Public/{name}',
+              {'params': {'IBIRS_action': 'get'}})
+             for name in schedule_names]
+        )
+        for item_name, response in zip(schedule_names, responses):
+            content = revalidate(('schedule', item_name), response,
+                                 valid=response_returncode_ok)
+            # Keep the listing attributes if details could not be fetched
+            if content is None:
+                continue
+            schedule = schedule_xml_to_dict(item_name, ET.fromstring(content))
+            item_dict = schedule_items[item_name]
+            item_dict['id'] = schedule['ID']
+            item_dict['last_time_executed'] = schedule['Last Time Executed']
+            item_dict['status_last_executed'] = schedule['Status Last Executed']
+            item_dict['next_run_time'] = schedule['Next Run Time']
+
         # Creates a list of 2-tuples (item_name, item_dict) sorted by datecreated, most to least recent
         schedule_items_list = sorted(
             schedule_items.items(), 
@@ -309,10 +555,11 @@ def schedules():
 
         return render_template('schedules.html', schedules=schedule_items_list, expand=True)
 
-@app.route('/run_schedule', methods=['POST'])
+@bp.route('/run_schedule', methods=['POST'])
 def run_schedule():
     schedule_name = request.form.get('schedule_name')
     wf_sess = wf_login()
+    ibi_rest_url = current_app.config['IBI_REST_URL']
     payload = {
         'IBIRS_action': 'run',
     }
@@ -333,44 +580,18 @@ def run_schedule():
     return redirect(request.referrer)
 
 
-@app.route('/view_schedule_log', methods=['GET'])
-def view_schedule_log():
-    schedule_name = request.args.get('schedule_name')
-    # If no schedule requested, give users a dropdown of available
-    if not schedule_name: 
-        files_xml = list_files_in_path_xml(file_type="CasterSchedule")
-        # schedules is a list of schedule names
-        schedules = []
-        for item in files_xml:
-            schedule_name = item.get("name")
-            schedules.append(schedule_name)
-        return render_template(
-            "schedule_log_info.html", schedule=None, schedules=schedules
-        )
-    wf_sess = wf_login()
-    # Get schedule xml object
-    params = {'IBIRS_action': 'get'}
-    response = wf_sess.get(
-        f'{ibi_rest_url}/ibfs/WFC/Repository/Public/{schedule_name}',
-        params=params
-    )
-    # Parse xml for schedule id
-    if response.status_code != 200:
-        return 'Error: Could not communicate with WebFOCUS Client' + \
-            f'<br> <a href="{url_for("schedules")}">Go Back</a>', 404
-    root = ET.fromstring(response.content)
-    if root.attrib['returncode'] != "10000":
-        print("error retcode != 10k")
-        return 'Error 404: Could not retrieve selected schedule.' + \
-            f'<br> <a href="{url_for("schedules")}">Go Back</a>', 404
+# Parses the xml root of a schedule 'get' response into a dict of
+# schedule information, keyed by the labels shown in schedule_log_info.html
+def schedule_xml_to_dict(schedule_name, root):
     for child in root:
         if child.tag == 'rootObject':
             rootObject = child
-    schedule_id = rootObject.attrib['handle'] 
+    schedule_id = rootObject.attrib['handle']
     # Parse xml for more schedule information
     for child in rootObject:
         if child.tag == 'casterObject':
             casterObject = child
+    lastTimeExecuted = None
     lastTimeExecuted_unix = casterObject.get('lastTimeExecuted')
     if lastTimeExecuted_unix:
         lastTimeExecuted = unixtime_ms_to_datetime(int(lastTimeExecuted_unix))
@@ -400,20 +621,73 @@ def view_schedule_log():
     for item in taskList:
         procedureName = item.get('procedureName')
         schedule['Procedures'].append(procedureName)
+    return schedule
 
-    # Have schedule id, now use it to retrieve log list 
-    url = f"{ibi_client_protocol}://{ibi_client_host}:{ibi_client_port}" + \
-          "/ibi_apps/services/LogServiceREST/getLogInfoListByScheduleId"
-
-    params = dict()
-    params['scheduleId'] = schedule_id
 
-    log_response = wf_sess.get(url, params=params)
-    if log_response.status_code != 200:
+@bp.route('/view_schedule_log', methods=['GET'])
+def view_schedule_log():
+    schedule_name = request.args.get('schedule_name')
+    # If no schedule requested, give users a dropdown of available
+    if not schedule_name: 
+        files_xml = list_files_in_path_xml(file_type="CasterSchedule")
+        # schedules is a list of schedule names
+        schedules = []
+        for item in files_xml:
+            schedule_name = item.get("name")
+            schedules.append(schedule_name)
+        return render_template(
+            "schedule_log_info.html", schedule=None, schedules=schedules
+        )
+    config = current_app.config
+    ibi_log_url = config['IBI_LOG_URL']
+    schedule_url = \
+        f'{config["IBI_REST_URL"]}/ibfs/WFC/Repository/Public/{schedule_name}'
+    params = {'IBIRS_action': 'get'}
+    # Schedule and log are served from the last known-good copy when
+    # WebFOCUS does not answer (see revalidate)
+    # If the schedule id is already known (e.g. from the expanded schedules
+    # table), fetch the schedule and its log at the same time
+    schedule_id = request.args.get('schedule_id')
+    if schedule_id:
+        response, log_response = wf_fan_out([
+            ('GET', schedule_url, {'params': params}),
+            ('GET', ibi_log_url, {'params': {'scheduleId': schedule_id}}),
+        ])
+        content = revalidate(('schedule', schedule_name), response,
+                             valid=response_returncode_ok)
+        if content is None and \
+                (response is None or response.status_code >= 500):
+            abort(503)
+    else:
+        # Get schedule xml object
+        content = wf_get_cached(('schedule', schedule_name), schedule_url,
+                                params, valid=response_returncode_ok)
+    # Parse xml for schedule id
+    if content is None:
+        print("error retcode != 10k")
+        return 'Error 404: Could not retrieve selected schedule.' + \
+            f'<br> <a href="{url_for(".schedules")}">Go Back</a>', 404
+    schedule = schedule_xml_to_dict(schedule_name, ET.fromstring(content))
+
+    # Have schedule id, now use it to retrieve log list if it was not
+    # already fetched alongside the schedule. The id from the query string
+    # is only trusted (and its log cached) once it matches the schedule's.
+    if schedule_id and schedule['ID'] == schedule_id:
+        log_content = revalidate(('log', schedule_name, schedule_id),
+                                 log_response)
+    else:
+        params = dict()
+        params['scheduleId'] = schedule['ID']
+        try:
+            log_content = wf_get_cached(
+                ('log', schedule_name, schedule['ID']), ibi_log_url, params)
+        except requests.exceptions.RequestException:
+            log_content = None
+    if log_content is None:
         flash(f"Could not receive log data for {schedule_name}")
         return render_template('schedule_log_info.html', schedule=schedule)
 
-    log_root = ET.fromstring(log_response.content)
+    log_root = ET.fromstring(log_content)
     # log_data is a list of log_item attribute dictionaries
     log_data = list()
 
@@ -473,10 +747,10 @@ def view_schedule_log():
 
 
 
-@app.route('/defer_reports')
+@bp.route('/defer_reports')
 def defer_reports():
     if not session.get('user_name'):
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
     files_xml = list_files_in_path_xml(file_type="FexFile")
     
@@ -490,7 +764,7 @@ def defer_reports():
 
 
 # Run report deferred and store id info in session
-@app.route('/defer_report', methods=['POST'])
+@bp.route('/defer_report', methods=['POST'])
 def defer_report():
     report_name = request.form.get('report_name')
     tDesc = request.form.get('IBIRS_tDesc')
@@ -506,12 +780,12 @@ def defer_report():
     if wf_sess.IBIWF_SES_AUTH_TOKEN is not None:
         payload['IBIWF_SES_AUTH_TOKEN'] = wf_sess.IBIWF_SES_AUTH_TOKEN
 
-    response = wf_sess.post(ibi_rest_url, data=payload)
+    response = wf_sess.post(current_app.config['IBI_REST_URL'], data=payload)
 
     if response.status_code != 200:
         print("Error status code != 200")
         flash("Error: Could not defer report.")
-        return redirect(url_for('defer_reports'))
+        return redirect(url_for('.defer_reports'))
 
     root = ET.fromstring(response.content)
 
@@ -519,14 +793,14 @@ def defer_report():
     if root.get('returncode') != "10000":
         print("Error retcode != 10k")
         flash("Error: Could not defer report.")
-        return redirect(url_for('defer_reports'))
+        return redirect(url_for('.defer_reports'))
 
     flash(f"Successfully ran deferred report: {report_name}")
-    return redirect(url_for('defer_reports'))
+    return redirect(url_for('.defer_reports'))
 
 
 # Retrieves deferred report data
-@app.route('/get_deferred_report', methods=['GET', 'POST'])
+@bp.route('/get_deferred_report', methods=['GET', 'POST'])
 def get_deferred_report():
     ticket_name = request.form.get('ticket_name')
     if not ticket_name:
@@ -551,7 +825,9 @@ def get_deferred_report():
         'IBIRS_args': turn_off_redirection_xml
     }
     params['IBIRS_ticketName'] = ticket_name
-    wf_response = wf_sess.get(ibi_rest_url, params=params)
+    wf_response = wf_sess.get(current_app.config['IBI_REST_URL'],
+                              params=params,
+                              timeout=current_app.config['IBI_RUN_TIMEOUT'])
     report = wf_response.content
     content_type = wf_response.headers.get('Content-Type')
     if 'text/html' in content_type:
@@ -576,11 +852,10 @@ def get_deferred_report():
     return response
 
 
-@app.route('/deferred_reports_table', methods=['GET'])
+@bp.route('/deferred_reports_table', methods=['GET'])
 def deferred_reports_table():
     if "user_name" not in session:
         return redirect('/')
-    wf_sess = wf_login()
 
     # used to sort table in html
     sort_reversed = True if request.args.get('reverse') == 'True' else False
@@ -589,14 +864,15 @@ def deferred_reports_table():
     payload = {"IBIRS_action": "listTickets"}
     payload['IBIRS_service'] = 'defer'
     payload['IBIRS_filters'] = payload['IBIRS_args'] = '__null'
-    payload['IBIWF_SES_AUTH_TOKEN'] = wf_sess.IBIWF_SES_AUTH_TOKEN
-    response = wf_sess.get(ibi_rest_url, params=payload)  # will be xml
-    # convert xml response to minimal dict for easy access
-    tree = ET.fromstring(response.text)
-    response_code = tree.get("returncode")
-    if response_code != '10000':
+    # served from the last known-good ticket list if WebFOCUS does not answer
+    content = wf_get_cached(('tickets',), current_app.config['IBI_REST_URL'],
+                            payload, valid=response_returncode_ok,
+                            csrf_token=True)  # will be xml
+    if content is None:
         flash("Error receiving deferred items")
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
+    # convert xml response to minimal dict for easy access
+    tree = ET.fromstring(content)
     root = tree.find('rootObject')
 
     deferred_tickets = dict()
@@ -645,9 +921,132 @@ def unixtime_ms_to_datetime(unixtime_ms):
     datetime_string = datetime_created.strftime("%Y-%m-%d %H:%M:%S")
     return datetime_string
 
+
+@bp.route('/ready')
+def ready():
+    # Readiness probe: fails until this worker process has finished warm_up
+    if not current_app.extensions['wf_ready'].is_set():
+        return 'Warming up', 503
+    return 'Ready'
+
+
+# Signs on pooled sessions, prefetches the default folder listing and
+# compiles all templates so the first requests after a deploy are not cold
+def warm_up(app):
+    try:
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+        with app.app_context():
+            # list_files_in_path_xml signs on the first session and the
+            # app context teardown puts it into the pool
+            list_files_in_path_xml()
+        with app.app_context():
+            pool = app.extensions['wf_sessions']
+            while len(pool) < app.config['IBI_SESSION_POOL_SIZE']:
+                pool.append(sign_on_wf_sess())
+    except (requests.exceptions.RequestException, HTTPException,
+            ET.ParseError) as e:
+        # Still serve requests; they will sign on and list on demand
+        app.logger.warning(f"WebFOCUS warm-up failed: {e}")
+    finally:
+        app.extensions['wf_ready'].set()
+
+
+# Per-process WebFOCUS state: session pool, cache, circuit breaker and
+# warm-up. Set up again in forked children (e.g. 'gunicorn --preload'
+# workers), which must not share the parent's sessions or locks, and whose
+# warm-up thread would otherwise only have run in the parent.
+def init_wf_state(app):
+    app.extensions['wf_sessions'] = deque()
+    # Last known-good WebFOCUS responses, see revalidate and cache_put
+    app.extensions['wf_cache'] = OrderedDict()
+    app.extensions['wf_cache_lock'] = threading.Lock()
+    # Keys being refreshed by refresh_in_background
+    app.extensions['wf_refreshing'] = set()
+    app.extensions['wf_breaker'] = wfrs.CircuitBreaker(
+        failure_threshold=app.config['IBI_BREAKER_FAILURES'],
+        reset_timeout=app.config['IBI_BREAKER_RESET'],
+        slow_call=app.config['IBI_BREAKER_SLOW_CALL']
+    )
+    app.extensions['wf_ready'] = threading.Event()
+    if app.config['IBI_WARM_UP']:
+        # Warm up in the background; /ready reports when this worker is done
+        threading.Thread(target=warm_up, args=(app,), daemon=True).start()
+    else:
+        app.extensions['wf_ready'].set()
+
+
+# Application factory; configuration is read from environment variables,
+# and config (a dict) overrides them. Serve the app with e.g.
+#   gunicorn 'app:create_app()'
+#   flask --app app run
+# ('gunicorn app:app' also still works, see __getattr__ below)
+def create_app(config=None):
+    app = Flask(__name__, template_folder='Templates')
+    env = os.environ
+    app.config.update(
+        # secret key randomly generated via commandline:
+        # python -c 'import os; print(os.urandom(16))'
+        SECRET_KEY=env.get('SECRET_KEY', 'Insert Secret Key Here'),
+        IBI_CLIENT_PROTOCOL=env.get('IBI_CLIENT_PROTOCOL', 'http'),
+        IBI_CLIENT_HOST=env.get('IBI_CLIENT_HOST', 'localhost'),
+        # standard is 80 for http and 443 for https
+        IBI_CLIENT_PORT=env.get('IBI_CLIENT_PORT', '8080'),
+        # WebFOCUS account the application signs on with
+        IBI_USER=env.get('IBI_USER', 'admin'),
+        IBI_PASSWORD=env.get('IBI_PASSWORD', 'admin'),
+        IBI_DEFAULT_FOLDER_PATH=env.get('IBI_DEFAULT_FOLDER_PATH',
+                                        'WFC/Repository/Public'),
+        # Bounds for concurrent WebFOCUS calls made with WF_Session.fan_out
+        IBI_FAN_OUT_WORKERS=int(env.get('IBI_FAN_OUT_WORKERS', 8)),
+        IBI_REQUEST_TIMEOUT=float(env.get('IBI_REQUEST_TIMEOUT', 10)),
+        # Overall limit (secs) for a whole fan_out, however many calls
+        IBI_FAN_OUT_DEADLINE=float(env.get('IBI_FAN_OUT_DEADLINE', 15)),
+        # Timeout (secs) for running reports, which can take much longer
+        IBI_RUN_TIMEOUT=float(env.get('IBI_RUN_TIMEOUT', 120)),
+        # Consecutive failed WebFOCUS calls that open the circuit breaker,
+        # and how long (secs) it stays open before trying again
+        IBI_BREAKER_FAILURES=int(env.get('IBI_BREAKER_FAILURES', 5)),
+        IBI_BREAKER_RESET=float(env.get('IBI_BREAKER_RESET', 30)),
+        # Successful calls slower than this (secs) also count as failures
+        # (0 to disable); report runs (IBI_RUN_TIMEOUT) never do
+        IBI_BREAKER_SLOW_CALL=float(env.get('IBI_BREAKER_SLOW_CALL', 5)),
+        # Signed on sessions kept between requests, and for how long (secs)
+        IBI_SESSION_POOL_SIZE=int(env.get('IBI_SESSION_POOL_SIZE', 4)),
+        IBI_SESSION_MAX_AGE=float(env.get('IBI_SESSION_MAX_AGE', 600)),
+        IBI_LISTING_TTL=float(env.get('IBI_LISTING_TTL', 30)),
+        # Most last known-good responses kept for stale fallback
+        IBI_CACHE_SIZE=int(env.get('IBI_CACHE_SIZE', 1000)),
+        IBI_WARM_UP=env.get('IBI_WARM_UP', '').lower() in ('1', 'true', 'yes'),
+    )
+    if config:
+        app.config.update(config)
+
+    ibi_client_url = f"{app.config['IBI_CLIENT_PROTOCOL']}://" + \
+        f"{app.config['IBI_CLIENT_HOST']}:{app.config['IBI_CLIENT_PORT']}"
+    app.config['IBI_APPS_URL'] = f'{ibi_client_url}/ibi_apps'
+    app.config['IBI_REST_URL'] = f'{ibi_client_url}/ibi_apps/rs'
+    app.config['IBI_LOG_URL'] = f'{ibi_client_url}/ibi_apps/services' + \
+        '/LogServiceREST/getLogInfoListByScheduleId'
+
+    app.register_blueprint(bp)
+    app.teardown_appcontext(teardown_wf_sess)
+
+    init_wf_state(app)
+    os.register_at_fork(after_in_child=lambda: init_wf_state(app))
+    return app
+
+
+# Module-level app for 'gunicorn app:app' and 'from app import app'. Built
+# on first access only, so that importing create_app does not build (and
+# warm up) an extra app.
+def __getattr__(name):
+    global app
+    if name == 'app':
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 if __name__ == '__main__':
-    # secret key randomly generated via commandline:
-    # python -c 'import os; print(os.urandom(16))'
-    # TODO: Add security; should import from config file or env variable
-    app.secret_key = 'Insert Secret Key Here'
-    app.run(host='0.0.0.0', port=5000)
+    create_app().run(host='0.0.0.0', port=5000)
@@ -5,20 +5,205 @@ Very simple authenticated API wrapper for requests.Session object
 Modeled from Ira Kaplan at Ira_Kaplan@ibi.com
 """
 
+import threading
+import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, wait
 import requests
 
 
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of calling WebFOCUS while the circuit breaker is open."""
+
+
+class SignOnError(requests.exceptions.RequestException):
+    """Raised when a sign-on reply carries no CSRF token, e.g. an error page
+    from a proxy in front of WebFOCUS."""
+
+
+class CircuitBreaker:
+    """Stops calling WebFOCUS after repeated failures.
+
+    After failure_threshold consecutive failed calls (connection errors,
+    timeouts, 5xx responses, or successes slower than slow_call seconds if
+    set) the breaker opens and calls fail fast for reset_timeout seconds.
+    It then lets a single trial call through: success closes the breaker
+    again, failure re-opens it.
+    Can be shared by several WF_Session objects (thread safe).
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, slow_call=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call = slow_call
+        self.failures = 0
+        self.opened_at = None
+        self._trial_call = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return whether a call may be made now."""
+
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial_call or \
+                    time.time() - self.opened_at < self.reset_timeout:
+                return False
+            self._trial_call = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_call = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_call or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+                self._trial_call = False
+
+
 class WF_Session(requests.Session):
-    def __init__(self):
+    def __init__(self, timeout=None, breaker=None, pool_maxsize=10):
         requests.Session.__init__(self)
+        # Keep a connection per concurrent fan_out call instead of
+        # discarding those above requests' default of 10 per host
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
         self.IBIWF_SES_AUTH_TOKEN = None
+        self.signed_on_at = None  # time.time() of the last sign-on
+        # Used for calls that do not pass their own timeout (seconds)
+        self.timeout = timeout
+        self.breaker = breaker
+        # fan_out calls still running after their deadline
+        self.abandoned_calls = 0
+        self._sign_on_lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        """requests.Session.request with a default timeout, guarded by
+        the circuit breaker if one is set. If WebFOCUS rejects the session
+        (see is_rejected), signs on again and retries the call once."""
+
+        token = self.IBIWF_SES_AUTH_TOKEN
+        response = self._send(method, url, **kwargs)
+        # No token: signing on or off, or already rejected
+        if token is None or not self.is_rejected(
+                response, kwargs.get('stream'), self._expects_xml(url, kwargs)):
+            return response
+        response.close()
+
+        with self._sign_on_lock:
+            # Concurrent fan_out calls may have signed on again already
+            if self.IBIWF_SES_AUTH_TOKEN in (token, None):
+                self.IBIWF_SES_AUTH_TOKEN = None
+                self.mr_sign_on(**self._sign_on_args)
+        # Payloads carry the rejected session's CSRF token
+        for name in ('data', 'params'):
+            value = kwargs.get(name)
+            if isinstance(value, dict) and \
+                    value.get('IBIWF_SES_AUTH_TOKEN') == token:
+                kwargs[name] = dict(value)
+                kwargs[name]['IBIWF_SES_AUTH_TOKEN'] = self.IBIWF_SES_AUTH_TOKEN
+        return self._send(method, url, **kwargs)
+
+    # IBFS actions that answer with report output rather than XML
+    REPORT_ACTIONS = ('run', 'getReport')
+
+    def _expects_xml(self, url, kwargs):
+        """Return whether this is an IBFS REST call that answers in XML."""
+
+        if '/ibi_apps/rs' not in url:
+            return False
+        for name in ('params', 'data'):
+            value = kwargs.get(name)
+            if isinstance(value, dict) and \
+                    value.get('IBIRS_action') in self.REPORT_ACTIONS:
+                return False
+        return True
+
+    def _send(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if self.breaker is None:
+            response = requests.Session.request(self, method, url, **kwargs)
+            self._check_rejected(response, kwargs.get('stream'),
+                                 self._expects_xml(url, kwargs))
+            return response
+
+        if not self.breaker.allow():
+            raise CircuitOpenError(f'Circuit breaker open, not calling {url}')
+        started = time.monotonic()
+        try:
+            response = requests.Session.request(self, method, url, **kwargs)
+        except BaseException:
+            # Also for non-requests errors and worker timeouts, so that a
+            # trial call always re-opens (or closes) the breaker
+            self.breaker.record_failure()
+            raise
+        if response.status_code >= 500 or \
+                self._is_slow(time.monotonic() - started, kwargs['timeout']):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        self._check_rejected(response, kwargs.get('stream'),
+                             self._expects_xml(url, kwargs))
+        return response
+
+    def _is_slow(self, elapsed, timeout):
+        """Return whether a call took longer than the breaker's slow_call.
+        Calls given a longer timeout than the session's (e.g. running
+        reports) are expected to be slow and never count."""
+
+        slow_call = self.breaker.slow_call
+        if not slow_call or elapsed < slow_call:
+            return False
+        return self.timeout is None or \
+            (timeout is not None and timeout <= self.timeout)
+
+    # Shown by WebFOCUS in place of the requested content when it no longer
+    # knows the session (e.g. after a restart)
+    SIGN_IN_PAGE_MARKERS = (b'WebFOCUS Sign In', b'/ibi_apps/signin')
+
+    def is_rejected(self, response, stream=False, expects_xml=False):
+        """Return whether WebFOCUS rejected the session for this response:
+        a 401/403, or its HTML sign-in page (possibly after a redirect)
+        instead of the requested content. With expects_xml, any HTML reply
+        counts. The body of a streamed response is not inspected, so as
+        not to consume it."""
+
+        if response.status_code in (401, 403):
+            return True
+        if response.status_code != 200 or \
+                'html' not in response.headers.get('Content-Type', ''):
+            return False
+        if expects_xml or '/signin' in response.url:
+            return True
+        if stream:
+            return False
+        return any(marker in response.content
+                   for marker in self.SIGN_IN_PAGE_MARKERS)
+
+    def _check_rejected(self, response, stream=False, expects_xml=False):
+        """Forget the CSRF token if WebFOCUS no longer accepts this session,
+        so it is signed off rather than reused."""
+
+        if self.is_rejected(response, stream, expects_xml):
+            self.IBIWF_SES_AUTH_TOKEN = None
 
     def _save_ibi_csrf_token(self, xml):
         """Save IBI_CSRF_Token_Value from response to sign-on request."""
 
-        tree = ET.fromstring(xml)
+        try:
+            tree = ET.fromstring(xml)
+        except ET.ParseError as e:
+            raise SignOnError(f'Could not parse sign-on response: {e}')
         token = tree.find('properties/entry[@key="IBI_CSRF_Token_Value"]')
+        if token is None or 'value' not in token.attrib:
+            raise SignOnError('No CSRF token in sign-on response')
 
         token_value = token.attrib['value']
         self.IBIWF_SES_AUTH_TOKEN = token_value
@@ -35,6 +220,9 @@ class WF_Session(requests.Session):
         self.protocol = protocol
         self.host = host
         self.port = port
+        # and for signing on again if WebFOCUS rejects the session
+        self._sign_on_args = dict(protocol=protocol, host=host, port=port,
+                                  userid=userid, password=password)
 
         data = {
             'IBIRS_action': 'signOn',
@@ -46,7 +234,9 @@ class WF_Session(requests.Session):
                                                    self.port)
 
         response = self.post(url=url, data=data)
+        response.raise_for_status()
         self._save_ibi_csrf_token(response.content)
+        self.signed_on_at = time.time()
 
     def mr_signoff(self):
         """WebFOCUS Repository: Signing-Off From WebFOCUS."""
@@ -57,3 +247,51 @@ class WF_Session(requests.Session):
                                                    self.port)
         self.IBIWF_SES_AUTH_TOKEN = None
         self.post(url=url, data=data)
+
+    def fan_out(self, calls, max_workers=8, timeout=10, deadline=None):
+        """Issue several requests concurrently on this signed-on session.
+
+        calls is a list of (method, url, kwargs) tuples. At most
+        max_workers requests are in flight at once and each one is given
+        its own timeout (seconds) unless its kwargs set one. If deadline
+        (seconds) is set, calls still pending when it expires are abandoned
+        and counted in abandoned_calls; their threads keep using this
+        session, so it should not be reused afterwards.
+        Returns the responses in the same order as calls; a call that
+        failed (requests.exceptions.RequestException), timed out or missed
+        the deadline is returned as None. Any other exception is re-raised.
+        """
+
+        if not calls:
+            return []
+
+        def send(call):
+            method, url, kwargs = call
+            kwargs = dict(kwargs)
+            kwargs.setdefault('timeout', timeout)
+            return self.request(method, url, **kwargs)
+
+        executor = ThreadPoolExecutor(max_workers=min(max_workers, len(calls)))
+        futures = [executor.submit(send, call) for call in calls]
+        wait(futures, timeout=deadline)
+        # Do not block on (or start) calls that missed the deadline
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        responses = []
+        for future in futures:
+            if not future.done():
+                if future.running():
+                    self.abandoned_calls += 1
+                responses.append(None)
+                continue
+            if future.cancelled():
+                responses.append(None)
+                continue
+            error = future.exception()
+            if error is None:
+                responses.append(future.result())
+            elif isinstance(error, requests.exceptions.RequestException):
+                responses.append(None)
+            else:
+                raise error
+        return responses